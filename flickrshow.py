@@ -26,6 +26,7 @@ import re
 import copy
 import datetime
 import shutil
+import json
 #try:
 #    import xml.etree.cElementTree as ET
 #except ImportError as error:
@@ -39,6 +40,10 @@ from operator import itemgetter
 # UTC? -seems like that's what it is
 FLICKR_TIME_ZERO = datetime.datetime(1970, 01, 01) 
 INSERT_DESCRIPTION = True
+# flickrsync.py's ID keyed store - not a set, skip it when looking for images
+FLICKRSYNC_STORE = "flickrsync.store"
+# Number of images in each lazily loaded manifest and description chunk
+MANIFEST_CHUNK = 500
 
 class ESTemplate(object):
     """
@@ -72,8 +77,14 @@ class ESTemplate(object):
             
         shutil.copytree(self.template_src_dir, self.dest_path)                
         if os.path.isdir(tmp):
-            shutil.rmtree(self.thumb_path)
+            if os.path.isdir(self.thumb_path):
+                shutil.rmtree(self.thumb_path)
+            elif not os.path.isdir(os.path.dirname(self.thumb_path)):
+                os.makedirs(os.path.dirname(self.thumb_path))
             shutil.move(tmp, self.thumb_path)
+        elif not os.path.isdir(self.thumb_path):
+            # The template need not provide the thumbnail folder
+            os.makedirs(self.thumb_path)
     
     def _create_thumbnail(self, img_path):
         """ Create a thumnail and return it's location """
@@ -90,8 +101,11 @@ class ESTemplate(object):
                 # keep going - not fatal
         return thumbnail_path
         
-    def add(self, img_id, imgfile_path, title, desc_elem):
-        """ Add an image to the slideshow, create a thumbnail for it too. """
+    def add(self, img_id, imgfile_path, title, desc_elem, when=None, latlon=None, setname=None):
+        """ 
+        Add an image to the slideshow, create a thumbnail for it too. 
+        The when, latlon and setname are for templates that can show them. 
+        """
         imgfile_relative   = os.path.relpath(imgfile_path, self.dest_path)
         thumbnail_relative = os.path.relpath(self._create_thumbnail(imgfile_path), self.dest_path)   
         
@@ -119,6 +133,61 @@ class ESTemplate(object):
             index_file.write('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"\n"http://www.w3.org/TR/html4/strict.dtd">\n')
             self.template.write(index_file, encoding='UTF-8', method="html")
 
+class LazyTemplate(ESTemplate):
+    """
+    Create a slideshow folder that loads lazily - for use with LazyTemplate.html.
+
+    Rather than embedding every thumbnail in index.html, the image list is 
+    written as a chunked manifest in the manifest sub-folder, along with 
+    separate chunks of descriptions.  The template's script only renders the 
+    thumbnails scrolled into view and loads the chunks as they are needed.
+    
+    Each chunk is JSON wrapped in a call to flickrshow.chunk(kind, number, data),
+    so that the browser can load them with script tags from file:// urls.
+    """
+    
+    MANIFEST_FIELDS = ["id", "title", "large", "thumb", "width", "height", "taken", "lat", "lon", "set"]
+
+    def __init__(self, template_path, mirror_path, slide_show_name='HTML-SlideShow', replace=False):
+        ESTemplate.__init__(self, template_path, mirror_path, slide_show_name, replace)
+        self.manifest_path = os.path.join(self.dest_path, "manifest")
+        self.images = []
+        self.descriptions = []
+
+    def add(self, img_id, imgfile_path, title, desc_elem, when=None, latlon=None, setname=None):
+        """ Add an image to the manifest, create a thumbnail for it too. """
+        imgfile_relative   = os.path.relpath(imgfile_path, self.dest_path)
+        thumbnail_relative = os.path.relpath(self._create_thumbnail(imgfile_path), self.dest_path)   
+        try:
+            # Only reads the image header
+            (width, height) = Image.open(imgfile_path).size
+        except IOError as error:
+            print(imgfile_path, error)
+            (width, height) = (None, None)
+        (lat, lon) = (float(latlon[0]), float(latlon[1])) if latlon else (None, None)
+        # strftime refuses dates before 1900 on python 2 - old scanned photos have them
+        taken = when.isoformat(' ')[:16] if when else None
+        self.images.append([img_id, title, imgfile_relative, thumbnail_relative, width, height, taken, lat, lon, setname])
+        self.descriptions.append(ET.tostring(desc_elem, method="html") if INSERT_DESCRIPTION else "")
+
+    def _write_script(self, filename, function, *args):
+        """ Write a javascript file that calls function with args as JSON """
+        with open(os.path.join(self.manifest_path, filename), 'w') as script_file:
+            script_file.write("flickrshow.%s(%s);\n" % (function, ",".join(json.dumps(arg, separators=(',', ':')) for arg in args)))
+
+    def finish(self):
+        """ Call to finish the slideshow - writing out the manifest and index.html """
+        if not os.path.isdir(self.manifest_path):
+            os.makedirs(self.manifest_path)
+        for number, start in enumerate(range(0, len(self.images), MANIFEST_CHUNK)):
+            self._write_script("thumbs-%04d.js" % number, "chunk", "thumbs", number, self.images[start:start + MANIFEST_CHUNK])
+            self._write_script("desc-%04d.js" % number, "chunk", "desc", number, self.descriptions[start:start + MANIFEST_CHUNK])
+        self._write_script("index.js", "manifest", 
+                           {"count": len(self.images), "chunk_size": MANIFEST_CHUNK, "fields": self.MANIFEST_FIELDS})
+        # The template's script clones the prototype thumbnail for the visible images
+        self.thumb_list.append(self.thumb_item_proto)
+        ESTemplate.finish(self)
+
 def create_html_description(desc):
     """
     Create a description element, not necessariliy specific to ESTemplate
@@ -146,6 +215,8 @@ def read_image_data(mirrorpath):
     img_list = []
     already_showing = {}
     for (dirpath, dirnames, files) in os.walk(mirrorpath):
+        if FLICKRSYNC_STORE in dirnames:
+            dirnames.remove(FLICKRSYNC_STORE)
         for filename in files:
             if re.match('[0-9]+[.]xml', filename):
                 #print( filename)
@@ -174,6 +245,7 @@ if __name__ == '__main__':
             description="Use templateFolder to create a slide-show inside imageFolder by creating an HTML sub-folder in imageFolder.")
     opt_parser.add_option('-r',  '--replace',  dest='replace', action='store_true', default=False,  help="Replace existing slide-show sub-folder in mirrorFolder")
     opt_parser.add_option('-n',  '--slide-show-name',  dest='showname', default="HTML-Slide-Show",  help="Name for the slide show folder within the mirrorFolder.")
+    opt_parser.add_option('-l',  '--lazy',  dest='lazy', action='store_true', default=False,  help="Write a chunked manifest for a lazy loading template such as LazyTemplate.html.")
     options, args = opt_parser.parse_args()
 
     if len(args) == 2:
@@ -188,14 +260,15 @@ if __name__ == '__main__':
     # Sort into date taken order                
     img_list.sort(key=itemgetter(6), reverse=True)
     
-    template = ESTemplate(templatepath, mirrorpath, slide_show_name=options.showname, replace=options.replace)
+    template_class = LazyTemplate if options.lazy else ESTemplate
+    template = template_class(templatepath, mirrorpath, slide_show_name=options.showname, replace=options.replace)
     
     for (img_id, title, desc, dir_path, setname, latlon, when) in img_list:
         # Can only handle images (exclude videos)
         for ok_type in (".jpg", ".png", ".gif"):
             img_path = os.path.join(dir_path, img_id + ok_type)
             if os.path.exists(img_path):
-                template.add(img_id, img_path, escape(title.strip()), create_html_description(desc))
+                template.add(img_id, img_path, escape(title.strip()), create_html_description(desc), when, latlon, setname)
                 break
     
     template.finish()
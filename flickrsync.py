@@ -44,6 +44,11 @@ import errno
 import re
 import datetime
 import time
+import subprocess
+import socket
+import threading
+from multiprocessing import Pool, TimeoutError
+from multiprocessing.pool import ThreadPool
 from xml.dom.minidom import getDOMImplementation
 from optparse import OptionParser
 
@@ -60,6 +65,60 @@ PER_PAGE = 500
 info_saved = {}
 cache_index = {}
 
+# Canonical ID keyed store - each image and its xml is saved here once as
+# flickrsync.store/ab/cd/<id>.<ext> and linked (or copied) into the set folders.
+# The per-set membership lists saved under STORE_SETS_DIR allow the set 
+# folders to be rebuilt offline by --relink.
+STORE_DIR = "flickrsync.store"
+STORE_SETS_DIR = os.path.join(STORE_DIR, "sets")
+
+# Don't seem to be able to tell what kind of video something is until we
+# download it - so guess every possibility when looking in the cache
+MEDIA_TYPES = (".jpg", ".gif", ".png", ".video", ".mpg", ".avi", ".mov", ".mpeg", ".3gp", ".m2ts", ".ogg", ".ogv", "")   
+
+# Number of files passed to each cp command when relinking
+LINK_BATCH = 200
+
+# Several flickrsync processes, perhaps on different hosts, may share
+# the store (see --shard).  A download is claimed by creating a lock file 
+# next to the stored file.  A lock held by a process on this host that no
+# longer exists is broken straight away, otherwise a lock not refreshed for 
+# STALE_LOCK_SECS is assumed to belong to a killed run.  Downloads refresh their
+# lock every LOCK_REFRESH_SECS.  Shard progress is recorded under STORE_SHARDS_DIR.
+STORE_SHARDS_DIR = os.path.join(STORE_DIR, "shards")
+STALE_LOCK_SECS = 3600
+LOCK_REFRESH_SECS = 60
+LOCK_POLL_SECS = 2
+
+# Media is streamed to disk in pieces of this size
+DOWNLOAD_BUFFER = 1024 * 1024
+
+# --verify caches the md5 of each checked store file, keyed by (inode, size, mtime),
+# so that later audits only need to read files that have changed.
+VERIFY_CACHE = os.path.join(STORE_DIR, "verify.cache")
+VERIFY_BUFFER = 4 * 1024 * 1024
+# Every complete image of these types ends with the given trailer
+# (within the final VERIFY_TAIL bytes - some cameras append a little padding).
+# The single byte gif trailer is common in the compressed data, so it must be
+# the last byte other than null padding.
+IMAGE_TRAILERS = { ".jpg":("\xff\xd9", False), ".png":("IEND", False), ".gif":(";", True) }
+VERIFY_TAIL = 1024
+# check_store_file result for a file whose size couldn't be got from flickr
+UNCHECKED = "size unavailable from flickr"
+
+# The photo element attributes used by download_photo and download_photoinfo -
+# the concurrent engine copies these rather than keeping the page doms.
+PHOTO_ATTRIBUTES = ("id", "title", "lastupdate")
+
+# Seconds between checks on the concurrent engine's tasks - waiting in short
+# steps lets python 2 deliver KeyboardInterrupt to the main thread.
+TASK_POLL_SECS = 1
+
+# With --workers, requests to each host are limited to host_limit at a time
+host_limit = 4
+host_slots = {}
+host_slots_lock = threading.Lock()
+
 def gettext(dom, tagname):
     """
     Helper function to extract text from a dom node
@@ -71,6 +130,16 @@ def gettext(dom, tagname):
             rc = rc + node.data
     return rc.encode("utf-8")
 
+def host_slot(url):
+    """
+    Get the semaphore limiting the number of concurrent requests to url's host.
+    """
+    host = urlparse.urlparse(url).hostname
+    with host_slots_lock:
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(host_limit)
+        return host_slots[host]
+
 def do_request(url, debug=False):
     """
     Make a REST request to flickr, check the rst error status.
@@ -78,10 +147,11 @@ def do_request(url, debug=False):
     Return: the XML parsed into a DOM
     """
     if debug: print "request: ", url
-    # Make the request
-    response = urllib2.urlopen(url)
-    # Parse the reponse XML
-    dom = xml.dom.minidom.parse(response)
+    with host_slot(url):
+        # Make the request
+        response = urllib2.urlopen(url)
+        # Parse the reponse XML
+        dom = xml.dom.minidom.parse(response)
     if debug: print "response:", dom.toxml(encoding="UTF-8")
     if dom.getElementsByTagName("rsp")[0].getAttribute("stat") != "ok":
         print "Flickr request failed:", dom.toxml(encoding="UTF-8")
@@ -244,32 +314,211 @@ def save_xml(dom, tagname, filename):
     fh.close()   
     newdoc.unlink()
 
+def is_linked(fromfile, tofile, use_copy=False):
+    """
+    Check whether tofile is already a link (or an up to date copy) of fromfile.
+    """
+    if not os.path.exists(tofile):
+        return False
+    if os.name == 'posix':
+        if os.path.samefile(fromfile, tofile):
+            return not use_copy
+        if not use_copy:
+            return False
+    # A copy is current if it is the same size and no older than the original
+    return os.path.getsize(fromfile) == os.path.getsize(tofile) and os.path.getmtime(tofile) >= os.path.getmtime(fromfile)
+
 def link_local_file(fromfile, tofile, use_copy=False):
     """
     Hard links fromfile to tofile. On Windows a copy is used instead of a link.
     If options.do_links is False, then copies instead of linking.
     """
+    if is_linked(fromfile, tofile, use_copy):
+        return # already linked
+    if os.path.exists(tofile):
+        try:        
+            os.remove(tofile) # force the link by getting rid of the file
+        except OSError as error:
+            if error.errno !=  errno.ENOENT:
+                raise
     if os.name == 'posix' and not use_copy:
-        if os.path.exists(tofile):
-            if os.path.samefile(fromfile, tofile):
-                return # already linked
-            try:        
-                os.remove(tofile) # force the link by getting rid of the file
-            except OSError as error:
-                if error.errno !=  errno.ENOENT:
-                    raise
         print "    Link file     :", fromfile, "-->", tofile
         os.link(fromfile, tofile)
     else:  # boo, os lacks links
         print "    Copy file     :", fromfile, "-->", tofile
-        if os.path.exists(tofile):
-            try:        
-                os.remove(tofile)
-            except OSError as error:
-                if error.errno !=  errno.ENOENT:
-                    raise
         shutil.copyfile(fromfile, tofile)        
 
+def store_path(photoid):
+    """
+    Return the canonical store folder for a photo ID - the first two
+    pairs of hex digits of the ID's md5 spread the store over 65536 folders.
+    """
+    digest = md5.new(photoid).hexdigest()
+    return os.path.join(STORE_DIR, digest[0:2], digest[2:4])
+
+def find_media_file(directory, photoid):
+    """
+    Look for an image or video for photoid in directory - any file type.
+    
+    Return: the file path or None
+    """
+    for filetype in MEDIA_TYPES:
+        target = os.path.join(directory, photoid + filetype)
+        if os.path.exists(target):
+            return target
+    return None
+
+def adopt_local_file(local_file, store_file):
+    """
+    Move a file downloaded into a set folder by an older version into
+    the store, by linking it there.  
+    
+    Return: True if the store now has the file
+    """
+    if os.path.exists(store_file):
+        return True
+    if not os.path.exists(local_file):
+        return False
+    create_local_path(os.path.dirname(store_file))
+    link_local_file(local_file, store_file)
+    return True
+
+def create_lock_file(lock_file):
+    """
+    Atomically create lock_file, recording who holds it.
+    O_EXCL creation is atomic locally and on NFSv3 or later.
+    
+    Return: False if it already exists
+    """
+    try:
+        lock_fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+        return False
+    os.write(lock_fd, "%s %d\n" % (socket.gethostname(), os.getpid()))
+    os.close(lock_fd)
+    return True
+
+def is_stale_lock(lock_file):
+    """
+    Check whether lock_file is older than STALE_LOCK_SECS - left by a killed run.
+    """
+    try:
+        return time.time() - os.path.getmtime(lock_file) > STALE_LOCK_SECS
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return False # released while we looked at it
+
+def read_lock_holder(lock_file):
+    """
+    Read the host and process ID recorded in lock_file by create_lock_file.
+
+    Return: (host, pid), or None if released or not yet written
+    """
+    try:
+        fh = open(lock_file, "r")
+        contents = fh.read()
+        fh.close()
+    except IOError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return None
+    try:
+        (host, pid) = contents.split()
+        return (host, int(pid))
+    except ValueError:
+        return None
+
+def is_abandoned_lock(lock_file):
+    """
+    Check whether lock_file was left by a process on this host that has
+    gone, or by any process that stopped refreshing it (see is_stale_lock).
+    """
+    holder = read_lock_holder(lock_file)
+    if holder and holder[0] == socket.gethostname():
+        try:
+            os.kill(holder[1], 0)
+        except OSError as error:
+            if error.errno == errno.ESRCH:
+                return True
+    return is_stale_lock(lock_file)
+
+def break_stale_lock(lock_file):
+    """
+    Remove lock_file if it is abandoned.  Only the holder of a second break 
+    lock may remove it, and the lock is checked again while holding that, so
+    a waiter can't remove a fresh lock that has replaced the abandoned one.
+    """
+    break_file = lock_file + ".break"
+    if not create_lock_file(break_file):
+        # The break lock is only held briefly - unless its holder was killed
+        if is_abandoned_lock(break_file):
+            release_store_lock(break_file)
+        return
+    try:
+        if is_abandoned_lock(lock_file):
+            print "    Remove abandoned lock:", lock_file
+            release_store_lock(lock_file)
+    finally:
+        release_store_lock(break_file)
+
+def acquire_store_lock(lock_file):
+    """
+    Claim a store download by creating lock_file - waits for any other 
+    process (eg another shard) holding the lock to release it first.
+    """
+    waiting_for = None
+    while not create_lock_file(lock_file):
+        if is_abandoned_lock(lock_file):
+            break_stale_lock(lock_file)
+            continue
+        holder = read_lock_holder(lock_file)
+        if holder and holder != waiting_for:
+            print "    Waiting for lock held by %s %d: %s" % (holder[0], holder[1], lock_file)
+            waiting_for = holder
+        time.sleep(LOCK_POLL_SECS)
+
+def release_store_lock(lock_file):
+    """
+    Release a lock obtained by acquire_store_lock.
+    """
+    try:
+        os.remove(lock_file)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+def is_current(store_file, marker_file, last_update, refresh=False):
+    """
+    Check that store_file exists and, if refreshing, that it has already
+    been downloaded for flickr's current last_update of the photo (perhaps 
+    by another shard).  The last_update a file was downloaded for is saved
+    in its marker_file by mark_current.
+    """
+    if store_file is None or not os.path.exists(store_file):
+        return False
+    if not refresh:
+        return True
+    try:
+        marker = open(marker_file, "r")
+        current = marker.read() == last_update
+        marker.close()
+        return current
+    except IOError as error:
+        if error.errno != errno.ENOENT:
+            raise
+    return False
+
+def mark_current(marker_file, last_update):
+    """
+    Record the flickr last_update that a store file was downloaded for.
+    """
+    marker = open(marker_file, "w")
+    marker.write(last_update)
+    marker.close()
+
 def download_size_info(auth, photoid):
     """
     Download the image size options from the server
@@ -295,108 +544,142 @@ def download_size_info(auth, photoid):
         print "Failed to retrieve photo sizes", photoid, error
     return (imgurl, media)
 
-def download_media(auth, imgurl, proto_name):
+def download_media(auth, imgurl, proto_name, lock_file=None):
     """
     Download the actual the photo from the server.
     Proto_name is the path and name lacking a file type suffix.
     The suffix will be determined from the download response and the
     final path/name.suffix will be returned.
     
+    The store lock_file, if any, is refreshed while a long download runs
+    so that other processes don't take it to be stale.
+    
     Return the filename the image was saved to
     """
     try:
-        response = urllib2.urlopen(imgurl)
-        # Work out file type from response
-        file_type = ""  
-        if response.info().has_key('Content-Type'):
-            content_type = response.info()['Content-Type'].split('image/')[1]
-            file_type = "." + (content_type if content_type != "jpeg" else "jpg")
-        if response.info().has_key('Content-Disposition'):                
-            content_name = response.info()['Content-Disposition'].split('filename=')[1]
-            file_type = os.path.splitext(content_name)[1]
-        filename = proto_name + file_type
-        data = response.read()    
-        # Save the file!
-        fh = open(filename, "w")
-        fh.write(data)
-        fh.close()
+        with host_slot(imgurl):
+            response = urllib2.urlopen(imgurl)
+            # Work out file type from response
+            file_type = ""  
+            if response.info().has_key('Content-Type'):
+                content_type = response.info()['Content-Type'].split('image/')[1]
+                file_type = "." + (content_type if content_type != "jpeg" else "jpg")
+            if response.info().has_key('Content-Disposition'):                
+                content_name = response.info()['Content-Disposition'].split('filename=')[1]
+                file_type = os.path.splitext(content_name)[1]
+            filename = proto_name + file_type
+            # Save the file!
+            fh = open(filename, "w")
+            refreshed = time.time()
+            while True:
+                data = response.read(DOWNLOAD_BUFFER)
+                if not data:
+                    break
+                fh.write(data)
+                if lock_file and time.time() - refreshed > LOCK_REFRESH_SECS:
+                    os.utime(lock_file, None)
+                    refreshed = time.time()
+            fh.close()
     except Exception as error:
-        print "Failed to retrieve photo id", photoid, error
+        print "Failed to retrieve photo", proto_name, error
         filename = None
     return filename
 
-def download_photo(auth, photo_dom, localdir, use_links=True, force_refresh=False):
+def download_photo(auth, photo_dom, local_dir, use_links=True, force_refresh=False):
     """
-    Download the photo image and save it - won't download
+    Download the photo image and save it to the store - won't download
     if we already have it (pass refresh=True to force a refresh).
     
-    Links or copies files across sets if they are the same - so a
-    file is only downloaded once.
+    Links or copies the file from the store into the set's local_dir - so 
+    a file is only downloaded once.
     """
     global cache_index # photos saved this run
     photoid = photo_dom.getAttribute("id")
+    last_update = photo_dom.getAttribute("lastupdate").encode("utf-8")
 
     # Have we seen this image already on this run?
-    if photoid in cache_index and cache_index[photoid] and os.access(cache_index[photoid], os.R_OK):
-        # Aready encountered on this run, use cache copy
-        target = os.path.join(local_dir, os.path.basename(cache_index[photoid]))
-        link_local_file(cache_index[photoid], target, use_copy=not use_links)
-        return
-        
-    # OK, haven't seen it yet, has it been cached on disk by a previous run? 
-    if not force_refresh:
-        # Don't seem to be able to tell what kind of video something is until we
-        # download it - so guess every possibility when looking in the cache
-        possible_types = (".jpg", ".gif", ".png", ".video", ".mpg", ".avi", ".mov", ".mpeg", ".3gp", ".m2ts", ".ogg", ".ogv", "")   
-        for filetype in possible_types:
-            target = os.path.join(localdir, photoid + filetype)
-            if os.path.exists(target):
-                # First time encountered on this run, but already on disk
-                cache_index[photoid] = target
+    if not (photoid in cache_index and cache_index[photoid] and os.access(cache_index[photoid], os.R_OK)):
+        store_dir = store_path(photoid)
+        lock_file = os.path.join(store_dir, photoid + ".lock")
+        marker_file = os.path.join(store_dir, photoid + ".lastupdate")
+        # OK, haven't seen it yet, has it been cached on disk by a previous run? 
+        store_file = find_media_file(store_dir, photoid)
+        if not is_current(store_file, marker_file, last_update, force_refresh) or os.path.exists(lock_file):
+            # Missing, or being downloaded by another process - take the lock and look again
+            create_local_path(store_dir)
+            acquire_store_lock(lock_file)
+            try:
+                store_file = find_media_file(store_dir, photoid)
+                if store_file is None and not force_refresh:
+                    legacy_file = find_media_file(local_dir, photoid)
+                    if legacy_file:
+                        store_file = os.path.join(store_dir, os.path.basename(legacy_file))
+                        adopt_local_file(legacy_file, store_file)
+                if not is_current(store_file, marker_file, last_update, force_refresh):
+                    # Need to download from scratch
+                    store_file = None
+                    imgurl, media = download_size_info(auth, photoid)
+                    if imgurl:
+                        print "    Download", media, ":", local_dir, photo_dom.getAttribute("title").encode("utf8"), "[ id=" + photoid, "]"
+                        store_file = download_media(auth, imgurl, os.path.join(store_dir, photoid), lock_file)
+                        if store_file:
+                            mark_current(marker_file, last_update)
+            finally:
+                release_store_lock(lock_file)
+            if not store_file:
                 return
-                
-    # Need to download from scratch
-    imgurl, media = download_size_info(auth, photoid)
-    if imgurl:
-        proto_name = os.path.join(local_dir, photoid)
-        print "    Download", media, ":", local_dir, photo_dom.getAttribute("title").encode("utf8"), "[ id=" + photoid, "]"
-        finalname = download_media(auth, imgurl, proto_name)
-        if finalname:
-            cache_index[photoid] = finalname
+        cache_index[photoid] = store_file
+
+    target = os.path.join(local_dir, os.path.basename(cache_index[photoid]))
+    link_local_file(cache_index[photoid], target, use_copy=not use_links)
 
 def download_photoinfo(auth, photo_dom, local_dir, use_links=True, refresh=False):
     """
-    Download the XML info for a photo and save it - won't download
-    if we already have it (pass refresh=True to force a refresh).
+    Download the XML info and comments for a photo and save them to the 
+    store - won't download if we already have it (pass refresh=True to 
+    force a refresh).
     
-    Links or copies files across sets if they are the same - so a
-    file is only downloaded once.
+    Links or copies the files from the store into the set's local_dir - so 
+    a file is only downloaded once.
     """        
     global info_saved
     photoid = photo_dom.getAttribute("id")
-    photoxml = os.path.join(local_dir, photoid + ".xml")    
-    if photoid in info_saved and os.access(info_saved[photoid], os.R_OK):
-        link_local_file(info_saved[photoid], photoxml, use_copy=not use_links)
-    else:
-        if os.path.exists(photoxml) and not refresh:
-            info_saved[photoid] = photoxml
-            return
-    
-        print "    Download info: ", local_dir, photo.getAttribute("title").encode("utf8")
-        photo_dom = do_signed_request(auth, "flickr.photos.getInfo", { "photo_id":photoid })
-        num_comments = int(str.strip(gettext(photo_dom, "comments")))
-              
-        save_xml(photo_dom, "photo", photoxml) 
+    last_update = photo_dom.getAttribute("lastupdate").encode("utf-8")
+    store_dir = store_path(photoid)
+    photoxml = os.path.join(store_dir, photoid + ".xml")    
+    commentsxml = os.path.join(store_dir, photoid + "-comments.xml")
+    lock_file = os.path.join(store_dir, photoid + "-info.lock")
+    marker_file = os.path.join(store_dir, photoid + "-info.lastupdate")
+    if not (photoid in info_saved and os.access(info_saved[photoid], os.R_OK)):
+        if not is_current(photoxml, marker_file, last_update, refresh) or os.path.exists(lock_file):
+            # Missing, or being downloaded by another process - take the lock and look again
+            create_local_path(store_dir)
+            acquire_store_lock(lock_file)
+            try:
+                if not refresh and adopt_local_file(os.path.join(local_dir, photoid + ".xml"), photoxml):
+                    adopt_local_file(os.path.join(local_dir, photoid + "-comments.xml"), commentsxml)
+                if not is_current(photoxml, marker_file, last_update, refresh):
+                    print "    Download info: ", local_dir, photo_dom.getAttribute("title").encode("utf8")
+                    info_dom = do_signed_request(auth, "flickr.photos.getInfo", { "photo_id":photoid })
+                    num_comments = int(str.strip(gettext(info_dom, "comments")))
+                          
+                    save_xml(info_dom, "photo", photoxml) 
+                    
+                    print "         Comments: ", num_comments
+                    comments_dom = do_signed_request(auth, "flickr.photos.comments.getList", { "photo_id":photoid })
+                    save_xml(comments_dom, "comments", commentsxml)
+                    comments_dom.unlink()
+                                        
+                    # Free the DOM memory
+                    info_dom.unlink()
+                    mark_current(marker_file, last_update)
+            finally:
+                release_store_lock(lock_file)
         info_saved[photoid] = photoxml
-        
-        print "         Comments: ", num_comments
-        comments_dom = do_signed_request(auth, "flickr.photos.comments.getList", { "photo_id":photoid })
-        commentsfile = os.path.join(local_dir, photoid + "-comments.xml")
-        save_xml(comments_dom, "comments", commentsfile)
-        comments_dom.unlink()
-                            
-        # Free the DOM memory
-        photo_dom.unlink()
+
+    for store_file in (photoxml, commentsxml):
+        if os.path.exists(store_file):
+            link_local_file(store_file, os.path.join(local_dir, os.path.basename(store_file)), use_copy=not use_links)
 
 def download_collections_info(auth, filename):
     """
@@ -437,6 +720,14 @@ def recently_updated(auth, days):
         page = page + 1
     return photo_ids
 
+def set_folder_name(photo_set):
+    """
+    Decide on a local destination directory for a set based on the set name.
+    """
+    local_dir = gettext(photo_set, "title")
+    return re.sub(':', '-', re.sub('[/\\\\]','--', unicodedata.normalize('NFKD', local_dir.decode("utf-8",
+"ignore")).encode('ASCII', 'ignore'))) # Normalize to ASCII
+
 def create_list_requests(sets_dom, specific_set_ids=None, do_favourites=False):
     """
     Create a list of flickr requests for the sets we need to examine.
@@ -459,19 +750,217 @@ def create_list_requests(sets_dom, specific_set_ids=None, do_favourites=False):
     for photo_set in photo_sets:
         photoset_id = photo_set.getAttribute("id")
         if specific_set_ids == None or photoset_id in specific_set_ids:
-            local_dir = gettext(photo_set, "title")
-            local_dir = re.sub(':', '-', re.sub('[/\\\\]','--', unicodedata.normalize('NFKD', local_dir.decode("utf-8",
-"ignore")).encode('ASCII', 'ignore'))) # Normalize to ASCII
+            local_dir = set_folder_name(photo_set)
             # Build the list of get set of photos
             sets_to_get.append( ("flickr.photosets.getPhotos", { "photoset_id":photoset_id, "extras":extras }, local_dir) )
     if specific_set_ids == None:
         # Add the photos which are not in any set
-        sets_to_get.append( ("flickr.photos.getNotInSet", {}, "No Set") )
+        sets_to_get.append( ("flickr.photos.getNotInSet", { "extras":extras }, "No Set") )
         if do_favourites:
             # Add the user's Favourites
-            sets_to_get.append( ("flickr.favorites.getList", {}, "Favourites") )
+            sets_to_get.append( ("flickr.favorites.getList", { "extras":extras }, "Favourites") )
     return sets_to_get
 
+def iter_set_pages(auth, op, args):
+    """
+    Request each page of the photo list for one of the requests from 
+    create_list_requests.  The caller should unlink each page dom when done.
+
+    Return: a generator of (page dom, photo elements) tuples
+    """
+    # Get 500 results per page (there is a limit, we can't get them all at once)
+    args["per_page"] = str(PER_PAGE)
+
+    pages = page = 1
+    while page <= pages:
+        # Get the current page number
+        args["page"] = str(page)
+        # Get this page from the set
+        photos_dom = do_signed_request(auth, op, args)             
+        photo_elems = photos_dom.getElementsByTagName("photo")
+        # Get the total pages in the results - parentNode type varies, so we climb up from photo
+        if photo_elems.length != 0: pages = int(photo_elems[0].parentNode.getAttribute("pages"))                    
+        yield (photos_dom, photo_elems)
+        # Move on the next page
+        page = page + 1
+
+def photo_attributes(photo):
+    """
+    Copy the PHOTO_ATTRIBUTES of a photo element, so the page dom it came
+    from can be unlinked.
+    """
+    return dict((name, photo.getAttribute(name)) for name in PHOTO_ATTRIBUTES)
+
+def create_photo_element(attributes):
+    """
+    Create a stand-alone photo element with the given attributes, for 
+    download_photo and download_photoinfo.  Unlink its ownerDocument when done.
+    """
+    photo_doc = getDOMImplementation().createDocument(None, "photo", None)
+    for (name, value) in attributes.items():
+        photo_doc.documentElement.setAttribute(name, value)
+    return photo_doc.documentElement
+
+def list_set_photos(auth, op, args, local_dir, stop=None):
+    """
+    Concurrent engine task - get the complete photo list for a set and 
+    save the set membership.  Each page dom is unlinked once its photo
+    attributes have been copied.  Gives up between pages if stop is set.
+
+    Return: (local_dir, list of photo attribute dicts)
+    """
+    print "Examining set:", local_dir 
+    if create_local_path(local_dir): print "  Created folder:", local_dir 
+    photos = []
+    for (photos_dom, photo_elems) in iter_set_pages(auth, op, args):
+        photos.extend(photo_attributes(photo) for photo in photo_elems)
+        photos_dom.unlink()
+        if stop and stop.is_set():
+            return (local_dir, [])
+    # Remember which photos are in the set - for --relink
+    save_set_membership(request_set_key(args, local_dir), local_dir, [photo["id"] for photo in photos])
+    return (local_dir, photos)
+
+def sync_photo(auth, attributes, local_dir, do_metadata, use_links, force_download, stop=None):
+    """
+    Concurrent engine task - exactly what the serial engine does for each photo.
+    Does nothing if stop is set.
+    """
+    if stop and stop.is_set():
+        return
+    photo = create_photo_element(attributes)
+    try:
+        if do_metadata: download_photoinfo(auth, photo, local_dir, use_links, force_download)
+        download_photo(auth, photo, local_dir, use_links, force_download)
+    finally:
+        photo.ownerDocument.unlink()
+
+def sync_sets_concurrently(auth, sets_to_get, only_these_photo_ids, workers, do_metadata=True, use_links=True):
+    """
+    Alternative to the serial main loop - sets are listed by a small pool of
+    threads while each photo's info and media are fetched by a pool of 
+    workers.  Requests are limited per host by host_slot, so most workers 
+    spend their time waiting on the network rather than on the GIL.  
+    The store locks stop two workers fetching the same photo, so the files 
+    saved are the same as for the serial engine.
+    """
+    stop = threading.Event()
+    list_pool = ThreadPool(min(workers, 4))
+    photo_pool = ThreadPool(workers)
+    results = []
+    listings = list_pool.imap_unordered(lambda request: list_set_photos(auth, *request, stop=stop), sets_to_get)
+    try:
+        while True:
+            try:
+                (local_dir, photos) = listings.next(TASK_POLL_SECS)
+            except TimeoutError:
+                results = check_tasks(results)
+                continue
+            except StopIteration:
+                break
+            for attributes in photos:
+                force_download = only_these_photo_ids and attributes["id"] in only_these_photo_ids
+                results.append(photo_pool.apply_async(sync_photo, (auth, attributes, local_dir, do_metadata, use_links, force_download, stop)))
+            results = check_tasks(results)
+        while len(results) != 0:
+            results[0].wait(TASK_POLL_SECS)
+            results = check_tasks(results)
+    except BaseException:
+        # Queued tasks return straight away, the ones in progress finish
+        # and release their store locks.
+        print "Stopping - waiting for the downloads in progress"
+        stop.set()
+        raise
+    finally:
+        list_pool.close()
+        photo_pool.close()
+        list_pool.join()
+        photo_pool.join()
+
+def check_tasks(results):
+    """
+    Raise the exception from the first failed concurrent engine task.
+
+    Return: the results of the tasks that haven't finished
+    """
+    unfinished = []
+    for result in results:
+        if result.ready():
+            result.get()
+        else:
+            unfinished.append(result)
+    return unfinished
+
+def request_set_key(args, local_dir):
+    """
+    Identify the set a list request is for - the photoset id, or the 
+    local_dir for the No Set and Favourites pseudo-sets.
+    """
+    return args.get("photoset_id", local_dir)
+
+def select_shard(sets_to_get, shard, shard_count):
+    """
+    Deterministically partition the list requests from create_list_requests
+    by hashing each set's key.  Shards are numbered 1 to shard_count.
+
+    Return: the requests for this shard
+    """
+    return [(op, args, local_dir) for (op, args, local_dir) in sets_to_get
+            if int(md5.new(request_set_key(args, local_dir).encode("utf-8")).hexdigest(), 16) % shard_count + 1 == shard]
+
+def shard_path(shard, shard_count):
+    """
+    Return the folder where a shard saves its copy of the sets and collections info.
+    """
+    return os.path.join(STORE_SHARDS_DIR, "%dof%d" % (shard, shard_count))
+
+def finish_shard(shard_dir, recent_updates):
+    """
+    Mark a shard as having completed its sets, noting the --recent-updates
+    it was run with so the merge knows whether to save the last update time.
+    """
+    done_file = open(os.path.join(shard_dir, "done"), "w")
+    done_file.write(str(recent_updates))
+    done_file.close()
+
+def merge_shards(shard_count):
+    """
+    Once all shards have finished, write the shared photosets.xml from the 
+    union of the sets seen by each shard, and the collections.xml from the 
+    first shard.  If the shards were run with --recent-updates 0, save the
+    last update time on the FROB_CACHE.
+    
+    Return: False if some shards have not finished
+    """
+    shard_dirs = [shard_path(shard, shard_count) for shard in range(1, shard_count + 1)]
+    unfinished = [shard_dir for shard_dir in shard_dirs if not os.path.exists(os.path.join(shard_dir, "done"))]
+    if len(unfinished) != 0:
+        print "Shards not finished:", " ".join(unfinished)
+        return False
+    merged_dom = xml.dom.minidom.parse(os.path.join(shard_dirs[0], "photosets.xml"))
+    merged_sets = merged_dom.getElementsByTagName("photosets")[0]
+    seen_ids = set(photo_set.getAttribute("id") for photo_set in merged_sets.getElementsByTagName("photoset"))
+    for shard_dir in shard_dirs[1:]:
+        shard_dom = xml.dom.minidom.parse(os.path.join(shard_dir, "photosets.xml"))
+        for photo_set in shard_dom.getElementsByTagName("photoset"):
+            if photo_set.getAttribute("id") not in seen_ids:
+                seen_ids.add(photo_set.getAttribute("id"))
+                merged_sets.appendChild(merged_dom.importNode(photo_set, True))
+        shard_dom.unlink()
+    print "Merge photosets info:", "photosets.xml"
+    save_xml(merged_dom, "photosets", "photosets.xml")
+    merged_dom.unlink()
+    if os.path.exists(os.path.join(shard_dirs[0], "collections.xml")):
+        print "Merge collections info:", "collections.xml"
+        shutil.copyfile(os.path.join(shard_dirs[0], "collections.xml"), "collections.xml")
+    recent_updates = set(open(os.path.join(shard_dir, "done")).read() for shard_dir in shard_dirs)
+    if recent_updates == set(["0"]) and os.path.exists(FROB_CACHE):
+        # Use the date/time on the FROB_CACHE to save last update time
+        os.utime(FROB_CACHE, None)
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+    return True
+
 def create_local_path(local_dir):
     try:
         os.makedirs(local_dir)
@@ -481,6 +970,303 @@ def create_local_path(local_dir):
             raise OSError
     return False
 
+def save_set_membership(set_key, local_dir, photo_ids):
+    """
+    Save the list of photo ID's in a set to the store so that --relink can
+    rebuild the set folder without talking to flickr.  The set_key is the 
+    photoset id, or the local_dir for the No Set and Favourites pseudo-sets.
+    """
+    create_local_path(STORE_SETS_DIR)
+    impl = getDOMImplementation()
+    newdoc = impl.createDocument(None, "photoset", None)
+    root = newdoc.documentElement
+    root.setAttribute("id", set_key)
+    root.setAttribute("folder", local_dir.decode("utf-8"))
+    for photoid in photo_ids:
+        photo_elem = newdoc.createElement("photo")
+        photo_elem.setAttribute("id", photoid)
+        root.appendChild(photo_elem)
+    fh = open(os.path.join(STORE_SETS_DIR, set_key + ".xml"), "w")
+    fh.write(newdoc.toprettyxml(indent="  ", encoding="utf-8"))
+    fh.close()
+    newdoc.unlink()
+
+def link_set_files(local_dir, store_files, use_copy=False):
+    """
+    Link (or copy) a batch of store files into a set folder.  On linux the
+    work is handed to cp in batches of LINK_BATCH files - hard links, or 
+    reflinks where the file system supports them if copying.
+    """
+    todo = [store_file for store_file in store_files 
+            if not is_linked(store_file, os.path.join(local_dir, os.path.basename(store_file)), use_copy)]
+    if len(todo) == 0:
+        return
+    print "    Relink", len(todo), "files:", local_dir
+    for store_file in todo:
+        target = os.path.join(local_dir, os.path.basename(store_file))
+        if os.path.exists(target):
+            os.remove(target) # cp won't replace a link to the same file
+    if sys.platform.startswith("linux"):
+        cp_mode = "--reflink=auto" if use_copy else "--link"
+        for start in range(0, len(todo), LINK_BATCH):
+            subprocess.check_call(["cp", "--force", cp_mode] + todo[start:start + LINK_BATCH] + [local_dir])
+    else:
+        for store_file in todo:
+            link_local_file(store_file, os.path.join(local_dir, os.path.basename(store_file)), use_copy)
+
+def have_set_membership(sets_filename):
+    """
+    Check for the saved photosets XML and set membership lists needed to 
+    relink the set folders - mirrors made by older versions won't have the
+    membership lists until they have been synced.
+    """
+    for required in (sets_filename, STORE_SETS_DIR):
+        if not os.path.exists(required):
+            print "Cannot find", required, "- run a sync first to save the set information."
+            return False
+    return True
+
+def iter_set_membership(sets_filename):
+    """
+    Read the set membership lists saved by previous runs.  Set folders are 
+    named from the set titles in the saved photosets XML, sets no longer in
+    the XML are skipped.
+
+    Return: a generator of (local_dir, list of photo ID's) tuples
+    """
+    folders = {}
+    sets_dom = xml.dom.minidom.parse(sets_filename)
+    for photo_set in sets_dom.getElementsByTagName("photoset"):
+        folders[photo_set.getAttribute("id").encode("utf-8")] = set_folder_name(photo_set)
+    sets_dom.unlink()
+
+    for membership_file in sorted(os.listdir(STORE_SETS_DIR)):
+        set_dom = xml.dom.minidom.parse(os.path.join(STORE_SETS_DIR, membership_file))
+        root = set_dom.documentElement
+        set_key = root.getAttribute("id").encode("utf-8")
+        if set_key.isdigit() and set_key not in folders:
+            print "Set no longer exists:", set_key
+        else:
+            local_dir = folders.get(set_key, root.getAttribute("folder").encode("utf-8"))
+            yield (local_dir, [photo.getAttribute("id").encode("utf-8") for photo in root.getElementsByTagName("photo")])
+        set_dom.unlink()
+
+def relink_sets(sets_filename, use_links=True):
+    """
+    Rebuild all the set folders from the store, using only the saved photosets
+    XML and the set membership lists saved by previous runs - no flickr requests.
+    Set folders are named from the current set titles, so renamed sets 
+    get a new folder (the old one is left in place).
+    """
+    for (local_dir, photo_ids) in iter_set_membership(sets_filename):
+        print "Relink set:", local_dir
+        if create_local_path(local_dir): print "  Created folder:", local_dir 
+        store_files = []
+        for photoid in photo_ids:
+            store_dir = store_path(photoid)
+            media_file = find_media_file(store_dir, photoid)
+            if media_file is None:
+                print "    Not in store:", photoid
+                continue
+            store_files.append(media_file)
+            for suffix in (".xml", "-comments.xml"):
+                info_file = os.path.join(store_dir, photoid + suffix)
+                if os.path.exists(info_file):
+                    store_files.append(info_file)
+        link_set_files(local_dir, store_files, use_copy=not use_links)
+
+def hash_store_file(store_file):
+    """
+    Verify process pool task - read a store file in large buffers to find its 
+    md5 and check that images end with the right trailer.
+    
+    Return: (store_file, md5 hex digest, problem or None, suspect) - suspect
+    files may have been truncated, their size needs checking with flickr.
+    """
+    digest = md5.new()
+    tail = ""
+    try:
+        fh = open(store_file, "rb")
+        while True:
+            data = fh.read(VERIFY_BUFFER)
+            if not data:
+                break
+            digest.update(data)
+            tail = (tail + data[-VERIFY_TAIL:])[-VERIFY_TAIL:]
+        fh.close()
+    except IOError as error:
+        return (store_file, None, str(error), False)
+    if tail == "":
+        return (store_file, None, "empty file", False)
+    suspect = False
+    if os.path.splitext(store_file)[1] in IMAGE_TRAILERS:
+        (trailer, at_end) = IMAGE_TRAILERS[os.path.splitext(store_file)[1]]
+        suspect = not tail.rstrip("\0").endswith(trailer) if at_end else trailer not in tail
+    return (store_file, digest.hexdigest(), None, suspect)
+
+def download_media_size(auth, photoid):
+    """
+    Ask the server for the size of the original image or video.
+
+    Return: the size in bytes, or None if unknown
+    """
+    imgurl, media = download_size_info(auth, photoid)
+    if not imgurl:
+        return None
+    try:
+        request = urllib2.Request(imgurl)
+        request.get_method = lambda: "HEAD"
+        with host_slot(imgurl):
+            response = urllib2.urlopen(request)
+        try:
+            length = response.info().getheader("Content-Length")
+        finally:
+            response.close()
+        return int(length) if length else None
+    except Exception as error:
+        print "Failed to retrieve size", photoid, error
+    return None
+
+def check_store_file(auth, store_file, digest, previous_digest, suspect):
+    """
+    Verify thread pool task - compare the size of a changed or suspect store
+    file with the size on the server.
+
+    Return: (store_file, problem) - problem is None for a good file, UNCHECKED if
+    the size couldn't be got from flickr
+    """
+    if digest == previous_digest and not suspect:
+        return (store_file, None) # stat changed, but the content hasn't
+    photoid = os.path.splitext(os.path.basename(store_file))[0]
+    server_size = download_media_size(auth, photoid)
+    if server_size is None:
+        return (store_file, "truncated" if suspect else UNCHECKED)
+    local_size = os.path.getsize(store_file)
+    if local_size != server_size:
+        return (store_file, "size %d, flickr has %d" % (local_size, server_size))
+    return (store_file, None)
+
+def verify_store(auth, workers=1):
+    """
+    Audit the images and videos in the store.  Files that haven't changed
+    since the last audit are skipped, the rest are hashed and checked by a 
+    process pool, and their sizes compared with flickr by a pool of workers.
+
+    Return: list of photo ID's that need to be downloaded again
+    """
+    try:
+        cache_file = open(VERIFY_CACHE, "rb")
+        verified = cPickle.load(cache_file)
+        cache_file.close()
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        verified = {}
+
+    changed = {}
+    for (dirpath, dirnames, files) in os.walk(STORE_DIR):
+        if dirpath == STORE_DIR:
+            dirnames[:] = [dirname for dirname in dirnames if len(dirname) == 2] # just the ab/cd folders
+        for filename in files:
+            (photoid, filetype) = os.path.splitext(filename)
+            if photoid.isdigit() and filetype in MEDIA_TYPES:
+                store_file = os.path.join(dirpath, filename)
+                stat = os.stat(store_file)
+                key = (stat.st_ino, stat.st_size, stat.st_mtime)
+                if store_file not in verified or verified[store_file][0] != key:
+                    changed[store_file] = key
+    print "Verify", len(changed), "new or changed files"
+
+    bad_ids = []
+    def record(store_file, digest, problem):
+        if problem == UNCHECKED:
+            # Leave it out of the cache so the next audit tries again
+            print "    Not checked  :", store_file, problem
+            verified.pop(store_file, None)
+        elif problem:
+            print "    Bad file     :", store_file, problem
+            bad_ids.append(os.path.splitext(os.path.basename(store_file))[0])
+            verified.pop(store_file, None)
+        else:
+            verified[store_file] = (changed[store_file], digest)
+
+    hash_pool = Pool()
+    check_pool = ThreadPool(workers)
+    checks = []
+    try:
+        hashes = hash_pool.imap_unordered(hash_store_file, changed.keys())
+        while True:
+            # Timed waits, so python 2 delivers KeyboardInterrupt
+            try:
+                (store_file, digest, problem, suspect) = hashes.next(TASK_POLL_SECS)
+            except TimeoutError:
+                continue
+            except StopIteration:
+                break
+            if problem:
+                record(store_file, digest, problem)
+            else:
+                previous_digest = verified[store_file][1] if store_file in verified else None
+                checks.append((digest, check_pool.apply_async(check_store_file, (auth, store_file, digest, previous_digest, suspect))))
+        for (digest, result) in checks:
+            while not result.ready():
+                result.wait(TASK_POLL_SECS)
+            (store_file, problem) = result.get()
+            record(store_file, digest, problem)
+        hash_pool.close()
+        check_pool.close()
+    except BaseException:
+        hash_pool.terminate()
+        check_pool.terminate()
+        raise
+    finally:
+        hash_pool.join()
+        check_pool.join()
+        # Keep what has been verified so far
+        cache_file = open(VERIFY_CACHE, "wb")
+        cPickle.dump(verified, cache_file, cPickle.HIGHEST_PROTOCOL)
+        cache_file.close()
+    print "Verify found", len(bad_ids), "bad files"
+    return bad_ids
+
+def stored_last_update(photoid):
+    """
+    Get flickr's lastupdate for a photo from its info xml in the store.
+
+    Return: the lastupdate, or "" if the info hasn't been saved
+    """
+    photoxml = os.path.join(store_path(photoid), photoid + ".xml")
+    if not os.path.exists(photoxml):
+        return ""
+    info_dom = xml.dom.minidom.parse(photoxml)
+    dates = info_dom.getElementsByTagName("dates")
+    last_update = dates[0].getAttribute("lastupdate").encode("utf-8") if dates else ""
+    info_dom.unlink()
+    return last_update
+
+def repair_photos(auth, sets_filename, photo_ids, use_links=True):
+    """
+    Download photos again via download_photo, then relink the sets - the
+    repaired file may have replaced the linked one.
+    """
+    remaining = set(photo_ids)
+    for (local_dir, set_photo_ids) in iter_set_membership(sets_filename):
+        for photoid in remaining.intersection(set_photo_ids):
+            remaining.remove(photoid)
+            cache_index.pop(photoid, None)
+            # Forget what the bad file was downloaded for, so it is always refreshed
+            try:
+                os.remove(os.path.join(store_path(photoid), photoid + ".lastupdate"))
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+            # Mark the new download with flickr's lastupdate, so -r doesn't fetch it again
+            photo_elem = create_photo_element({ "id":photoid, "lastupdate":stored_last_update(photoid) })
+            create_local_path(local_dir)
+            download_photo(auth, photo_elem, local_dir, use_links, force_refresh=True)
+            photo_elem.ownerDocument.unlink()
+    for photoid in remaining:
+        print "    Not in any set:", photoid
+    relink_sets(sets_filename, use_links)
+
       
 ######## Main Application ##########
 if __name__ == '__main__':
@@ -493,6 +1279,12 @@ if __name__ == '__main__':
     optParser.add_option('-f',  '--include-favourites',  dest='do_favourites', action='store_true', default=False,  help='Download favourites (in available size only).')
     optParser.add_option('-X',  '--exclude-metadata',  dest='do_metadata', action='store_false', default=True,  help="Do not download descriptions, etc as xml.")
     optParser.add_option('-L',  '--no-links',  dest='do_links', action='store_false', default=True,  help="Do not use file links, copy files instead.")
+    optParser.add_option('-R',  '--relink',  dest='relink', action='store_true', default=False,  help="Rebuild the set folders from the local store and saved set info, no downloading.")
+    optParser.add_option('-S',  '--shard',  dest='shard', default=None,  help="Sync only shard I of N of the sets, given as I/N. Run a process for each shard, then --merge-shards.")
+    optParser.add_option('-w',  '--workers',  type="int", dest='workers', default=0,  help="Download using N concurrent workers. 0 for one at a time.")
+    optParser.add_option('-H',  '--host-limit',  type="int", dest='host_limit', default=host_limit,  help="Limit concurrent workers to N requests per host.")
+    optParser.add_option('-V',  '--verify',  dest='verify', action='store_true', default=False,  help="Check the downloaded images and videos and download any bad ones again.")
+    optParser.add_option('-M',  '--merge-shards',  type="int", dest='merge_shards', default=0,  help="Write the sets and collections info once all N shards have finished. Saves the last run time if the shards used -r 0.")
     (options, args) = optParser.parse_args()
 
     if len(args) == 1:
@@ -501,54 +1293,95 @@ if __name__ == '__main__':
     else:
         optParser.print_help()
         sys.exit(1)
+    host_limit = options.host_limit
+
+    shard = shard_count = None
+    if options.shard:
+        try:
+            (shard, shard_count) = [int(part) for part in options.shard.split("/")]
+        except ValueError:
+            optParser.error("--shard must be of the form I/N")
+        if not 1 <= shard <= shard_count:
+            optParser.error("--shard I/N requires 1 <= I <= N")
+
+    if options.merge_shards:
+        # Offline - no need for flickr authentication
+        if not merge_shards(options.merge_shards):
+            sys.exit(1)
+        sys.exit(0)
+
+    if options.relink or options.verify:
+        # Both rebuild the set folders from the saved set information
+        if not have_set_membership("photosets.xml"):
+            sys.exit(1)
+
+    if options.relink:
+        # Offline - no need for flickr authentication
+        relink_sets("photosets.xml", options.do_links)
+        sys.exit(0)
 
     # Get flickr authentication data - new or from FROB_CACHE
     auth = get_flickr_authorization()
     
+    if options.verify:
+        bad_ids = verify_store(auth, max(options.workers, 1))
+        if len(bad_ids) != 0:
+            repair_photos(auth, "photosets.xml", bad_ids, options.do_links)
+        sys.exit(0)
+
+    # A shard keeps its own copy of the sets info until --merge-shards
+    info_dir = "."
+    if shard:
+        info_dir = shard_path(shard, shard_count)
+        create_local_path(info_dir)
+        if os.path.exists(os.path.join(info_dir, "done")):
+            os.remove(os.path.join(info_dir, "done"))
+
     # Get the user's flickr sets
-    photosets_dom = download_sets_info(auth, "photosets.xml")
+    photosets_dom = download_sets_info(auth, os.path.join(info_dir, "photosets.xml"))
     # Save the photosets meta data
-    if options.do_metadata: download_collections_info(auth, "collections.xml")
+    if options.do_metadata: download_collections_info(auth, os.path.join(info_dir, "collections.xml"))
         
     # For each set - create a flickr REST url to get its contents
     specific_set_ids = options.setids.split(",") if options.setids else None
     sets_to_get = create_list_requests(photosets_dom, specific_set_ids, options.do_favourites)
     photosets_dom.unlink()
+    if shard:
+        sets_to_get = select_shard(sets_to_get, shard, shard_count)
+        print "Shard", shard, "of", shard_count, ":", len(sets_to_get), "sets"
 
     # If the user only wants recent stuff, ask flickr for recently updated photo ID's
     only_these_photo_ids = recently_updated(auth, options.recent_updates) if options.recent_updates != -1 else None
     if options.recent_updates != -1  and len(only_these_photo_ids) == 0:
         print "No updates"
+        if shard: finish_shard(info_dir, options.recent_updates)
         sys.exit(0)
 
     # Time to get the list of photos for each set, and download each photo
-    for (op, args, local_dir) in sets_to_get:
+    if options.workers > 0:
+        sync_sets_concurrently(auth, sets_to_get, only_these_photo_ids, options.workers, options.do_metadata, options.do_links)
+    else:
+        for (op, args, local_dir) in sets_to_get:
         
-        print "Examining set:", local_dir 
-        if create_local_path(local_dir): print "  Created folder:", local_dir 
+            print "Examining set:", local_dir 
+            if create_local_path(local_dir): print "  Created folder:", local_dir 
 
-        # Get 500 results per page (there is a limit, we can't get them all at once)
-        args["per_page"] = str(PER_PAGE)
-
-        pages = page = 1
-        while page <= pages:
-            # Get the current page number
-            args["page"] = str(page)
-            # Get this page from the set
-            photos_dom = do_signed_request(auth, op, args)             
-            photo_elems = photos_dom.getElementsByTagName("photo")
-            # Get the total pages in the results - parentNode type varies, so we climb up from photo
-            if photo_elems.length != 0: pages = int(photo_elems[0].parentNode.getAttribute("pages"))                    
-            # Grab the actual photos
-            for photo in photo_elems:
-                photoid = photo.getAttribute("id")
-                force_download = only_these_photo_ids and photoid in only_these_photo_ids
-                if options.do_metadata: download_photoinfo(auth, photo, local_dir, options.do_links, force_download)
-                download_photo(auth, photo, local_dir, options.do_links, force_download)
-            photos_dom.unlink()
-            # Move on the next page
-            page = page + 1
+            set_photo_ids = []
+            for (photos_dom, photo_elems) in iter_set_pages(auth, op, args):
+                # Grab the actual photos
+                for photo in photo_elems:
+                    photoid = photo.getAttribute("id")
+                    set_photo_ids.append(photoid)
+                    force_download = only_these_photo_ids and photoid in only_these_photo_ids
+                    if options.do_metadata: download_photoinfo(auth, photo, local_dir, options.do_links, force_download)
+                    download_photo(auth, photo, local_dir, options.do_links, force_download)
+                photos_dom.unlink()
+            # Remember which photos are in the set - for --relink
+            save_set_membership(request_set_key(args, local_dir), local_dir, set_photo_ids)
             
-    if options.recent_updates == 0:
+    if shard:
+        # The merge saves the last update time once every shard is done
+        finish_shard(info_dir, options.recent_updates)
+    elif options.recent_updates == 0:
         # Use the date/time on the FROB_CACHE to save last update time
         os.utime(FROB_CACHE, None)